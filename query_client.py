@@ -0,0 +1,107 @@
+import asyncio
+import argparse
+import json
+import time
+
+
+class QueryClient():
+    '''
+    A plain client for query_service.py keeping one HTTP/1.1 connection open
+    Inputs:
+        - host [str] (optional): service host
+        - port [int] (optional): service port
+    '''
+    def __init__(self, host='127.0.0.1', port=8026):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, payload=None):
+        '''
+        Sends a request and returns the HTTP status and the decoded JSON body
+        '''
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = b'' if payload is None else json.dumps(payload).encode()
+        head = ('%s %s HTTP/1.1\r\n'%(method, path) +
+                'Host: %s\r\n'%self.host +
+                'Content-Type: application/json\r\n' +
+                'Content-Length: %i\r\n\r\n'%len(body))
+        self.writer.write(head.encode() + body)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        response = await self.reader.readexactly(int(headers['content-length']))
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, json.loads(response)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.reader, self.writer = None, None
+
+    async def scenarios(self):
+        return await self.request('GET', '/scenarios')
+
+    async def spills(self, scenario, supercycle, hours, availability=None, cycle=None):
+        query = {'scenario': scenario, 'supercycle': supercycle, 'hours': hours, 'cycle': cycle}
+        if availability is not None:
+            query['availability'] = availability
+        return await self.request('POST', '/spills', query)
+
+    async def schedule(self, scenario, time_sharing='Protons only', availability=None):
+        query = {'scenario': scenario, 'time_sharing': time_sharing}
+        if availability is not None:
+            query['availability'] = availability
+        return await self.request('POST', '/schedule', query)
+
+    async def check(self, cycles):
+        return await self.request('POST', '/check', {'cycles': cycles})
+
+
+async def main(host, port, number_of_clients):
+    client = QueryClient(host, port)
+    status, scenarios = await client.scenarios()
+    print('Scenarios: %s'%', '.join(scenarios['scenarios']))
+
+    t0 = time.perf_counter()
+    status, result = await client.spills('Future', 'Physics', hours=1000, availability=0.8, cycle='ECN3_D (1.2s)')
+    print('ECN3_D (1.2s) spills in 1000 h of Future Physics at 80%%: %1.0f (%1.2f ms)'%(result['spills'], (time.perf_counter()-t0)*1e3))
+
+    t0 = time.perf_counter()
+    status, result = await client.schedule('Future', 'Protons only', availability=0.8)
+    print('Future scenario, protons only, free PS BPs: %1.2f%% (%1.2f ms)'%(result['free_bps_percentage'], (time.perf_counter()-t0)*1e3))
+
+    for cycles in (['SFTPRO', 'deGauss'], ['SFTPRO']*3):
+        status, result = await client.check(cycles)
+        print('%s: %1.1f s, %1.2f MW, valid: %s'%(' + '.join(cycles), result['length'], result['average_power'], result['valid']))
+    await client.close()
+
+    # concurrent clients, answered by batched evaluations
+    clients = [QueryClient(host, port) for i in range(number_of_clients)]
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*[c.spills('Typical', 'Physics', hours=100+i, availability=0.8, cycle='SFTPRO')
+                                     for i, c in enumerate(clients)])
+    print('%i concurrent spills queries answered in %1.2f ms (%i errors)'%(
+        number_of_clients, (time.perf_counter()-t0)*1e3, sum(status != 200 for status, _ in results)))
+    for c in clients:
+        await c.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Test client for query_service.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8026)
+    parser.add_argument('--clients', type=int, default=100, help='number of concurrent clients')
+    args = parser.parse_args()
+    asyncio.run(main(args.host, args.port, args.clients))
@@ -0,0 +1,522 @@
+import asyncio
+import argparse
+import json
+import numpy as np
+
+import constants as cnst
+from classes import SuperCycle
+
+
+#######################################################
+# Preloaded SPS supercycles scenarios (as in 01_get_SHiP_spills.ipynb)
+#######################################################
+SPS_SUPERCYCLES_SCENARIOS_COMPOSITIONS = {
+    'Typical': {
+        'AWAKE':                    ['AWAKE', 'SFTPRO', 'deGauss'],
+        'AWAKE with parallel MD':   ['AWAKE', 'MD parallel', 'SFTPRO'],
+        'Dedicated MD':             ['MD dedicated'],
+        'HiRadMat':                 ['HiRadMat', 'SFTPRO', 'deGauss'],
+        'LHC filling':              ['LHC filling', 'SFTPRO', 'deGauss'],
+        'LHC setup':                ['LHC pilot', 'SFTPRO', 'deGauss'],
+        'Physics':                  ['SFTPRO', 'deGauss'],
+        'Physics with parallel MD': ['MD parallel', 'SFTPRO'],
+        'Scrubbing':                ['Scrubbing', 'SFTPRO'],
+        'Thursday MD':              ['MD dedicated', 'SFTPRO'],
+    },
+    'Future': {
+        'AWAKE':                    ['AWAKE', 'AWAKE'] + ['ECN3_D (1.2s)']*3 + ['SFTPRO', 'deGauss'],
+        'AWAKE with parallel MD':   ['AWAKE', 'AWAKE'] + ['ECN3_D (1.2s)']*3 + ['MD parallel', 'SFTPRO', 'deGauss'],
+        'Dedicated MD':             ['MD dedicated'],
+        'HiRadMat':                 ['HiRadMat'] + ['ECN3_D (1.2s)']*4,
+        'LHC filling':              ['LHC filling', 'ECN3_D (1.2s)'],
+        'LHC setup':                ['LHC pilot'] + ['ECN3_D (1.2s)']*4,
+        'Physics':                  ['SFTPRO', 'deGauss'] + ['ECN3_D (1.2s)']*4,
+        'Physics with parallel MD': ['MD parallel', 'SFTPRO'] + ['ECN3_D (1.2s)']*4,
+        'Scrubbing':                ['Scrubbing', 'SFTPRO'],
+        'Thursday MD':              ['MD dedicated', 'SFTPRO', 'deGauss'] + ['ECN3_D (1.2s)']*2,
+    },
+}
+
+
+def build_supercycles_scenario(compositions, cycles=cnst.SPS_CYCLES, accelerator='SPS'):
+    '''
+    Builds a supercycles scenario from lists of cycle keys
+    Inputs:
+        - compositions [dict]: supercycle name -> list of cycle keys
+        - cycles [dict] (optional): cycles to pick from
+        - accelerator [str] (optional): accelerator name
+    '''
+    supercycles_scenario = {}
+    for name, cycle_keys in compositions.items():
+        supercycles_scenario[name] = SuperCycle(accelerator, name, [cycles[key] for key in cycle_keys])
+    return supercycles_scenario
+
+
+class CompiledScenario():
+    '''
+    Matrix representation of a supercycles scenario, so that many
+    allocations can be evaluated at once (same arithmetic as SuperCycle.allocate_hours
+    and SuperCycleScheduler.calculate_number_of_cycles)
+    Inputs:
+        - name [str]: scenario name
+        - supercycles_scenario [dict]: supercycle name -> SuperCycle
+    Other class variables:
+        - supercycle_names [list]: supercycle names (matrix rows)
+        - cycle_names [list]: unique cycle names (matrix columns)
+        - multiplicity [np.array]: number of times each cycle is played per supercycle
+        - length [np.array]: supercycles length [sec]
+        - average_power [np.array]: supercycles average power [MW]
+        - free_bps_per_supercycle [np.array]: free BPs of the injector per supercycle
+        - cycle_length [np.array]: cycles length [sec]
+    '''
+    def __init__(self, name, supercycles_scenario):
+
+        self.name = name
+        self.supercycles_scenario = supercycles_scenario
+        self.supercycle_names = list(supercycles_scenario.keys())
+        self.supercycle_index = {sc: i for i, sc in enumerate(self.supercycle_names)}
+
+        cycle_length = {}
+        for supercycle in supercycles_scenario.values():
+            for cycle in supercycle.cycles:
+                cycle_length.setdefault(cycle.name, cycle.length)
+        self.cycle_names = list(np.unique(list(cycle_length.keys())))
+        self.cycle_index = {c: i for i, c in enumerate(self.cycle_names)}
+        self.cycle_length = np.array([cycle_length[c] for c in self.cycle_names])
+
+        self.multiplicity = np.zeros((len(self.supercycle_names), len(self.cycle_names)))
+        self.length = np.zeros(len(self.supercycle_names))
+        self.average_power = np.zeros(len(self.supercycle_names))
+        self.free_bps_per_supercycle = np.zeros(len(self.supercycle_names))
+        for i, supercycle in enumerate(supercycles_scenario.values()):
+            for cycle in supercycle.cycles:
+                self.multiplicity[i, self.cycle_index[cycle.name]] += 1
+                self.free_bps_per_supercycle[i] += cycle.bps - cycle.coupled_cycle_bps
+            self.length[i] = supercycle.length
+            self.average_power[i] = supercycle.average_power
+
+    def allocate_hours(self, supercycle_indices, allocated_hours, machine_availability):
+        '''
+        Vectorized SuperCycle.allocate_hours over a batch of queries
+        Inputs:
+            - supercycle_indices [np.array]: row of each query
+            - allocated_hours [np.array]: allocated hours of each query
+            - machine_availability [np.array]: machine availability of each query
+        Returns number of supercycles played (queries) and number of cycles played (queries x cycles)
+        '''
+        allocated_seconds = allocated_hours*machine_availability*60*60
+        number_of_supercycles_played = allocated_seconds/self.length[supercycle_indices]
+        number_of_cycles_played = number_of_supercycles_played[:, None]*self.multiplicity[supercycle_indices]
+        return number_of_supercycles_played, number_of_cycles_played
+
+    def schedule(self, time_sharing_hours, machine_availability):
+        '''
+        Vectorized SuperCycleScheduler.calculate_number_of_cycles over a batch of queries
+        Inputs:
+            - time_sharing_hours [np.array]: hours per supercycle (queries x supercycles)
+            - machine_availability [np.array]: machine availability of each query
+        '''
+        allocated_seconds = time_sharing_hours*machine_availability[:, None]*60*60
+        number_of_supercycles_played = allocated_seconds/self.length[None, :]
+        number_of_cycles_played_total = number_of_supercycles_played @ self.multiplicity
+        injector_total_bps = allocated_seconds.sum(axis=1)/cnst.BASIC_PERIOD
+        injector_total_free_bps = number_of_supercycles_played @ self.free_bps_per_supercycle
+        return {
+            'number_of_cycles_played_total': number_of_cycles_played_total,
+            'time_sharing_of_cycles_total': number_of_cycles_played_total*self.cycle_length[None, :],
+            'injector_total_bps': injector_total_bps,
+            'injector_total_free_bps': injector_total_free_bps,
+            'free_bps_percentage': injector_total_free_bps/injector_total_bps*100,
+        }
+
+
+class ScenarioRegistry():
+    '''
+    In-memory registry of cycles and compiled supercycles scenarios
+    answering batches of what-if queries
+    Inputs:
+        - cycles [dict] (optional): cycles that compositions can be made of
+        - scenarios_compositions [dict] (optional): scenario name -> supercycle compositions
+        - time_sharing_hours [dict] (optional): named supercycles time sharings [hours]
+    Class methods:
+        spills: cycles played for a supercycle given allocated hours and availability
+        schedule: totals over a scenario given a time sharing and availability
+        check: whether a composition is within SPS length and power limits
+    Each method takes a list of query dicts and returns a list where every
+    entry is either a result dict or the ValueError raised by that query.
+    '''
+    def __init__(self,
+                 cycles=cnst.SPS_CYCLES,
+                 scenarios_compositions=SPS_SUPERCYCLES_SCENARIOS_COMPOSITIONS,
+                 time_sharing_hours=cnst.SPS_SUPERCYCLES_TIME_SHARING_HOURS):
+
+        self.cycles = cycles
+        self.time_sharing_hours = time_sharing_hours
+        self.scenarios = {}
+        for name, compositions in scenarios_compositions.items():
+            self.scenarios[name] = CompiledScenario(name, build_supercycles_scenario(compositions, cycles))
+
+        self.cycle_keys = list(cycles.keys())
+        self.cycle_key_index = {c: i for i, c in enumerate(self.cycle_keys)}
+        self.cycle_length = np.array([cycles[c].length for c in self.cycle_keys])
+        self.cycle_bps = np.array([cycles[c].bps for c in self.cycle_keys])
+        self.cycle_integrated_power = np.array([cycles[c].length*cycles[c].power for c in self.cycle_keys])
+
+    def describe(self):
+        '''
+        Summary of what is loaded
+        '''
+        return {
+            'cycles': self.cycle_keys,
+            'time_sharing': list(self.time_sharing_hours.keys()),
+            'scenarios': {name: {sc: scenario.supercycles_scenario[sc].cycle_names for sc in scenario.supercycle_names}
+                          for name, scenario in self.scenarios.items()},
+        }
+
+    def _get_scenario(self, query):
+        name = query.get('scenario')
+        if name not in self.scenarios:
+            raise ValueError('Unknown scenario %r, available: %s'%(name, ', '.join(self.scenarios)))
+        return self.scenarios[name]
+
+    @staticmethod
+    def _to_float(value, what):
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError('%s must be a number, got %r'%(what, value))
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError('%s must be a number, got %r'%(what, value))
+
+    def _get_availability(self, query):
+        availability = self._to_float(query.get('availability', cnst.SPS_AVAILABILITY), 'Machine availability')
+        if not 0 <= availability <= 1:
+            raise ValueError('Machine availability %1.2f not within [0, 1]'%availability)
+        return availability
+
+    def _get_hours(self, value, supercycle):
+        hours = self._to_float(value, 'Allocated hours to %s'%supercycle)
+        if not np.isfinite(hours) or hours < 0:
+            raise ValueError('Allocated hours %r to %s must be a finite non-negative number'%(value, supercycle))
+        return hours
+
+    def _parse_spills(self, query):
+        scenario = self._get_scenario(query)
+        supercycle = query.get('supercycle')
+        if supercycle not in scenario.supercycle_index:
+            raise ValueError('Unknown supercycle %r in scenario %s'%(supercycle, scenario.name))
+        if 'hours' not in query:
+            raise ValueError('Missing allocated hours')
+        cycle = query.get('cycle')
+        if cycle is not None and cycle not in scenario.cycle_index:
+            raise ValueError('Unknown cycle %r in scenario %s'%(cycle, scenario.name))
+        return scenario, scenario.supercycle_index[supercycle], self._get_hours(query['hours'], supercycle), self._get_availability(query)
+
+    def _parse_schedule(self, query):
+        scenario = self._get_scenario(query)
+        time_sharing = query.get('time_sharing', 'Protons only')
+        if isinstance(time_sharing, str):
+            if time_sharing not in self.time_sharing_hours:
+                raise ValueError('Unknown time sharing %r, available: %s'%(time_sharing, ', '.join(self.time_sharing_hours)))
+            time_sharing = self.time_sharing_hours[time_sharing]
+        missing = [sc for sc in scenario.supercycle_names if sc not in time_sharing]
+        if missing:
+            raise ValueError('No hours allocated to supercycles: %s'%', '.join(missing))
+        hours = [self._get_hours(time_sharing[sc], sc) for sc in scenario.supercycle_names]
+        availability = self._get_availability(query)
+        if availability*sum(hours) == 0: # no BPs at all, free BPs percentage undefined
+            raise ValueError('No effective hours allocated (availability %1.2f, total hours %1.1f)'%(availability, sum(hours)))
+        return scenario, hours, availability
+
+    def _parse_check(self, query):
+        cycle_keys = query.get('cycles')
+        if cycle_keys is not None and not isinstance(cycle_keys, list):
+            raise ValueError('cycles must be a list of cycle keys')
+        if not cycle_keys:
+            raise ValueError('Empty composition')
+        unknown = [c for c in cycle_keys if c not in self.cycle_key_index]
+        if unknown:
+            raise ValueError('Unknown cycles: %s'%', '.join(map(str, unknown)))
+        return [self.cycle_key_index[c] for c in cycle_keys]
+
+    def _parse_all(self, parse, queries):
+        results = [None]*len(queries)
+        parsed = {}
+        for i, query in enumerate(queries):
+            try:
+                parsed[i] = parse(query)
+            except (ValueError, TypeError) as error:
+                results[i] = ValueError(str(error))
+        return results, parsed
+
+    def spills(self, queries):
+        '''
+        Number of supercycles and cycles (i.e. spills) played for a supercycle
+        Query: {'scenario', 'supercycle', 'hours', 'availability' (optional), 'cycle' (optional)}
+        '''
+        results, parsed = self._parse_all(self._parse_spills, queries)
+        for scenario in self.scenarios.values():
+            batch = [i for i in parsed if parsed[i][0] is scenario]
+            if not batch:
+                continue
+            rows = np.array([parsed[i][1] for i in batch], dtype=int)
+            hours = np.array([parsed[i][2] for i in batch])
+            availability = np.array([parsed[i][3] for i in batch])
+            with np.errstate(over='ignore', invalid='ignore'):
+                number_of_supercycles_played, number_of_cycles_played = scenario.allocate_hours(rows, hours, availability)
+            finite = np.isfinite(number_of_cycles_played).all(axis=1) & np.isfinite(number_of_supercycles_played)
+            for j, i in enumerate(batch):
+                if not finite[j]:
+                    results[i] = ValueError('Allocated hours %r overflow the calculation'%queries[i]['hours'])
+                    continue
+                result = {
+                    'scenario': scenario.name,
+                    'supercycle': scenario.supercycle_names[rows[j]],
+                    'hours': hours[j],
+                    'availability': availability[j],
+                    'number_of_supercycles_played': float(number_of_supercycles_played[j]),
+                    'number_of_cycles_played': {c: float(number_of_cycles_played[j, k])
+                                                for c, k in scenario.cycle_index.items()
+                                                if scenario.multiplicity[rows[j], k] > 0},
+                }
+                if queries[i].get('cycle') is not None:
+                    result['spills'] = float(number_of_cycles_played[j, scenario.cycle_index[queries[i]['cycle']]])
+                results[i] = result
+        return results
+
+    def schedule(self, queries):
+        '''
+        Scenario totals, as SuperCycleScheduler.calculate_number_of_cycles
+        Query: {'scenario', 'time_sharing' (name or supercycle -> hours), 'availability' (optional)}
+        '''
+        results, parsed = self._parse_all(self._parse_schedule, queries)
+        for scenario in self.scenarios.values():
+            batch = [i for i in parsed if parsed[i][0] is scenario]
+            if not batch:
+                continue
+            hours = np.array([parsed[i][1] for i in batch])
+            availability = np.array([parsed[i][2] for i in batch])
+            with np.errstate(over='ignore', invalid='ignore'):
+                totals = scenario.schedule(hours, availability)
+            finite = np.isfinite(totals['time_sharing_of_cycles_total']).all(axis=1)
+            for key in ('injector_total_bps', 'injector_total_free_bps', 'free_bps_percentage'):
+                finite &= np.isfinite(totals[key])
+            for j, i in enumerate(batch):
+                if not finite[j]:
+                    results[i] = ValueError('Allocated hours overflow the calculation')
+                    continue
+                results[i] = {
+                    'scenario': scenario.name,
+                    'availability': availability[j],
+                    'injector_total_bps': float(totals['injector_total_bps'][j]),
+                    'injector_total_free_bps': float(totals['injector_total_free_bps'][j]),
+                    'free_bps_percentage': float(totals['free_bps_percentage'][j]),
+                    'number_of_cycles_played_total': dict(zip(scenario.cycle_names, totals['number_of_cycles_played_total'][j].tolist())),
+                    'time_sharing_of_cycles_total': dict(zip(scenario.cycle_names, totals['time_sharing_of_cycles_total'][j].tolist())),
+                }
+        return results
+
+    def check(self, queries):
+        '''
+        Whether a composition is within the SPS supercycle length and RMS power limits
+        Query: {'cycles': list of cycle keys}
+        '''
+        results, parsed = self._parse_all(self._parse_check, queries)
+        if not parsed:
+            return results
+        batch = list(parsed.keys())
+        counts = np.zeros((len(batch), len(self.cycle_keys)))
+        for j, i in enumerate(batch):
+            np.add.at(counts[j], parsed[i], 1)
+        length = counts @ self.cycle_length
+        bps = counts @ self.cycle_bps
+        average_power = (counts @ self.cycle_integrated_power)/length
+        for j, i in enumerate(batch):
+            within_length_limit = bool(length[j] <= cnst.SPS_SC_LENGTH_LIMIT)
+            within_power_limit = bool(average_power[j] <= cnst.SPS_RMS_POWER_LIMIT)
+            results[i] = {
+                'cycles': queries[i]['cycles'],
+                'length': float(length[j]),
+                'bps': int(bps[j]),
+                'average_power': float(average_power[j]),
+                'within_length_limit': within_length_limit,
+                'within_power_limit': within_power_limit,
+                'valid': within_length_limit and within_power_limit,
+            }
+        return results
+
+
+class QueryBatcher():
+    '''
+    Collects queries arriving concurrently and evaluates each kind
+    with a single vectorized registry call
+    Inputs:
+        - registry [ScenarioRegistry]: registry answering the queries
+        - batch_window [float] (optional): time to wait for more queries [sec]
+    '''
+    def __init__(self, registry, batch_window=0.001):
+        self.registry = registry
+        self.batch_window = batch_window
+        self.handlers = {'spills': registry.spills, 'schedule': registry.schedule, 'check': registry.check}
+        self.queue = asyncio.Queue()
+
+    async def submit(self, kind, query):
+        '''
+        Queue a query and wait for its result
+        '''
+        if not isinstance(query, dict):
+            raise ValueError('Query must be a JSON object')
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((kind, query, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(self.batch_window) # let concurrent queries pile up
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.evaluate(batch)
+
+    def evaluate(self, batch):
+        for kind, handler in self.handlers.items():
+            items = [item for item in batch if item[0] == kind]
+            if not items:
+                continue
+            try:
+                results = handler([query for _, query, _ in items])
+            except Exception as error: # should not happen, but do not leave clients hanging
+                results = [error]*len(items)
+            for (_, _, future), result in zip(items, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+#######################################################
+# Minimal HTTP/JSON front-end
+#######################################################
+_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def _to_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('%s is not JSON serializable'%type(obj).__name__)
+
+
+async def _respond(writer, status, payload, keep_alive):
+    try:
+        body = json.dumps(payload, default=_to_json, allow_nan=False).encode()
+    except (ValueError, TypeError) as error: # e.g. a non-finite result slipped through
+        status, body = 500, json.dumps({'error': 'Could not serialize response: %s'%error}).encode()
+    head = ('HTTP/1.1 %i %s\r\n'%(status, _STATUS[status]) +
+            'Content-Type: application/json\r\n' +
+            'Content-Length: %i\r\n'%len(body) +
+            'Connection: %s\r\n\r\n'%('keep-alive' if keep_alive else 'close'))
+    writer.write(head.encode() + body)
+    await writer.drain()
+
+
+async def _route(registry, batcher, method, path, body):
+    if path == '/scenarios':
+        if method != 'GET':
+            return 405, {'error': 'Use GET for %s'%path}
+        return 200, registry.describe()
+    kind = path.strip('/')
+    if kind not in batcher.handlers:
+        return 404, {'error': 'Unknown endpoint %s'%path}
+    if method != 'POST':
+        return 405, {'error': 'Use POST for %s'%path}
+    try:
+        query = json.loads(body or b'{}')
+        if isinstance(query, list): # several queries in one request
+            results = await asyncio.gather(*[batcher.submit(kind, q) for q in query], return_exceptions=True)
+            return 200, [{'error': str(r)} if isinstance(r, Exception) else r for r in results]
+        return 200, await batcher.submit(kind, query)
+    except ValueError as error: # includes json.JSONDecodeError
+        return 400, {'error': str(error)}
+
+
+def make_connection_handler(registry, batcher):
+    '''
+    Returns an asyncio.start_server callback serving JSON over HTTP/1.1 (keep-alive)
+    Endpoints:
+        - GET /scenarios
+        - POST /spills, /schedule, /check (single query or list of queries)
+    '''
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    raise ValueError('Malformed request line %r'%request_line.decode('latin-1').strip())
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                try:
+                    content_length = int(headers.get('content-length', 0))
+                except ValueError:
+                    raise ValueError('Malformed Content-Length %r'%headers['content-length'])
+                if content_length < 0:
+                    raise ValueError('Negative Content-Length %i'%content_length)
+                body = await reader.readexactly(content_length)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                try:
+                    status, payload = await _route(registry, batcher, method, path, body)
+                except Exception as error:
+                    status, payload = 500, {'error': str(error)}
+                await _respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except ValueError as error: # malformed request
+            try:
+                await _respond(writer, 400, {'error': str(error)}, False)
+            except ConnectionError:
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # client went away
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+    return handle_connection
+
+
+async def serve(host='127.0.0.1', port=8026, registry=None, batch_window=0.001):
+    '''
+    Loads the registry once and serves what-if queries until cancelled
+    '''
+    if registry is None:
+        registry = ScenarioRegistry()
+    batcher = QueryBatcher(registry, batch_window=batch_window)
+    batch_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(make_connection_handler(registry, batcher), host, port, backlog=1024)
+    print('Serving supercycle what-if queries on http://%s:%i'%(host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local what-if query service for supercycles scenarios')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8026)
+    parser.add_argument('--batch-window', type=float, default=0.001, help='[sec]')
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, batch_window=args.batch_window))